@@ -1,5 +1,6 @@
-from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 import os
+import re
 import sys
 import argparse
 
@@ -21,16 +22,24 @@ def parse_fasta(input_filename: str,
     # ensure output directory exists
     os.makedirs(out_dir, exist_ok=True)
 
-    sequences = SeqIO.parse(input_path, "fasta")
-    needle = exclude_phrase.lower()
-    filtered = [seq for seq in sequences if needle not in seq.description.lower()]
-
+    # Case-insensitive match without allocating a lowercased copy of every title
+    needle = re.compile(re.escape(exclude_phrase), re.IGNORECASE)
     output_path = os.path.join(out_dir, os.path.basename(input_filename))
     print(output_path)
-    with open(output_path, "w") as output:
-        SeqIO.write(filtered, output, "fasta")
 
-    print(f"[OK] Wrote {len(filtered)} sequences to {output_path}")
+    # Stream record-by-record with the low-level parser: no SeqRecord/Seq objects
+    # are built and only one record is held in memory at a time.
+    kept = 0
+    with open(input_path) as in_fh, open(output_path, "w") as out_fh:
+        for title, seq in SimpleFastaParser(in_fh):
+            if needle.search(title):
+                continue
+            out_fh.write(f">{title}\n")
+            for i in range(0, len(seq), 60):
+                out_fh.write(seq[i:i + 60] + "\n")
+            kept += 1
+
+    print(f"[OK] Wrote {kept} sequences to {output_path}")
 
 def main():
     ap = argparse.ArgumentParser(
@@ -6,17 +6,25 @@ import os
 import sys
 from mpi4py import MPI
 import subprocess
-from itertools import product
+import tempfile
+from itertools import groupby, product
 from typing import List, Tuple, Any, Dict
 
-# Note: On line 81, change the location of the diamond installtion
+# Note: In run_diamond_target_batch, change the location of the diamond installtion
 
 # Initialize MPI
 COMM = MPI.COMM_WORLD
 RANK = COMM.Get_rank()
 SIZE = COMM.Get_size()
 
+# Ranks sharing a node (and its memory), and one leader rank per node
+NODE_COMM = COMM.Split_type(MPI.COMM_TYPE_SHARED)
+NODE_RANK = NODE_COMM.Get_rank()
+LEADER_COMM = COMM.Split(0 if NODE_RANK == 0 else MPI.UNDEFINED, RANK)
+
 # Global variable to store the mapping from Genome ID to Taxon ID (BVBRC)
+# A plain dict on Rank 0 while tasks are generated, then a node-shared
+# SharedTaxonMap on every rank once Phase 1 is done.
 # Type hint for the global variable
 BVBRC_GENOME_TO_TAXID: Dict[str, str] = {}
 
@@ -51,52 +59,215 @@ def Subset(data: pd.DataFrame, stringdf: pd.DataFrame, genomesLST: List[str]) ->
     data = data[data['Genome ID'].isin(genomesLST)]
     return data
 
-# --- Diamond Execution Function (Processes a single pair) ---
+# --- Typed MPI transfer helpers (no pickling) ---
+
+def _to_fixed_bytes(values) -> np.ndarray:
+    """Encode strings into a fixed-width NumPy byte-string array (width = longest value)."""
+    encoded = [str(v).encode() for v in values]
+    width = max(map(len, encoded), default=1) or 1
+    return np.array(encoded, dtype=f"S{width}")
+
+class SharedTaxonMap:
+    """
+    Read-only Genome ID -> Taxon ID lookup over two sorted fixed-width byte arrays
+    that live in node-shared memory (one copy per node instead of one per rank).
+    Supports the dict-style .get() used by the DIAMOND workers.
+    """
+    def __init__(self, keys: np.ndarray, values: np.ndarray, wins: List[Any]):
+        self.keys, self.values = keys, values
+        self._wins = wins  # keep the MPI windows (and thus the memory) alive
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        k = str(key).encode()
+        i = int(np.searchsorted(self.keys, k))
+        if i < len(self.keys) and self.keys[i] == k:
+            return self.values[i].decode()
+        return default
+
+def share_string_map(mapping: Dict[str, str]) -> SharedTaxonMap:
+    """
+    Publish rank 0's str -> str mapping to every rank as a SharedTaxonMap.
+    One rank per node allocates an MPI shared-memory window for the sorted keys
+    and values, the node leaders receive the bytes with a typed Bcast, and the
+    other ranks on the node read the same pages through Shared_query.
+    """
+    meta = np.zeros(3, dtype=np.int64)
+    if RANK == 0:
+        keys = _to_fixed_bytes(mapping.keys())
+        values = _to_fixed_bytes(mapping.values())
+        order = np.argsort(keys, kind="stable")
+        keys, values = keys[order], values[order]
+        meta[:] = len(keys), keys.dtype.itemsize, values.dtype.itemsize
+    COMM.Bcast([meta, MPI.INT64_T], root=0)
+    n, key_width, value_width = (int(x) for x in meta)
+
+    arrays, wins = [], []
+    for col, width in enumerate((key_width, value_width)):
+        win = MPI.Win.Allocate_shared(n * width if NODE_RANK == 0 else 0, 1, comm=NODE_COMM)
+        win.Lock_all(MPI.MODE_NOCHECK)
+        buf, _ = win.Shared_query(0)
+        arr = np.ndarray(buffer=buf, dtype=f"S{width}", shape=(n,))
+        if RANK == 0:
+            arr[:] = (keys, values)[col]
+        if LEADER_COMM != MPI.COMM_NULL:
+            LEADER_COMM.Bcast([arr.view(np.uint8), MPI.BYTE], root=0)
+        arrays.append(arr)
+        wins.append(win)
+    # Node leaders have filled the shared pages before anyone reads them. The
+    # stores are plain memory writes, so Sync on both sides of the barrier makes
+    # them visible to the other ranks (MPI-3 unified-model shared-memory idiom).
+    for win in wins:
+        win.Sync()
+    NODE_COMM.Barrier()
+    for win in wins:
+        win.Sync()
+        win.Unlock_all()
+    return SharedTaxonMap(arrays[0], arrays[1], wins)
+
+def scatterv_pairs(pairs: List[Tuple[str, str]], counts: List[int]) -> List[Tuple[str, str]]:
+    """
+    Scatter contiguous chunks of rank 0's (query, target) pairs with COMM.Scatterv.
+    Each column travels as a fixed-width byte array; counts[i] pairs go to rank i.
+    """
+    meta = np.zeros(2 + SIZE, dtype=np.int64)
+    if RANK == 0:
+        queries = _to_fixed_bytes(p[0] for p in pairs)
+        targets = _to_fixed_bytes(p[1] for p in pairs)
+        meta[:] = [queries.dtype.itemsize, targets.dtype.itemsize] + list(counts)
+    COMM.Bcast([meta, MPI.INT64_T], root=0)
+    widths, counts = meta[:2], meta[2:]
+    displs = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    local = []
+    for col, width in enumerate(widths):
+        width = int(width)
+        recv = np.empty(int(counts[RANK]), dtype=f"S{width}")
+        send = None
+        if RANK == 0:
+            send = [(queries, targets)[col].view(np.uint8), counts * width, displs * width, MPI.BYTE]
+        COMM.Scatterv(send, [recv.view(np.uint8), MPI.BYTE], root=0)
+        local.append([v.decode() for v in recv.tolist()])
+    return list(zip(*local))
+
+# --- Diamond Execution Function (Processes all queries of one target DB) ---
+
+# Separator used to tag query protein IDs with their genome in the combined query FASTA
+QUERY_TAG_SEP = "::"
 
 # NOTE: The BVBRC_GENOME_TO_TAXID map is now accessed directly within the function,
 # having been correctly populated and broadcast to all ranks via the global variable.
-def run_diamond_single_pair(pair: Tuple[str, str], QPATH: str, TPATH: str, OUTPATH: str) -> str:
-    """Run DIAMOND blastp for a single query-target pair with hierarchical output."""
+def run_diamond_target_batch(target_tax_id: str, query_genome_ids: List[str],
+                             QPATH: str, TPATH: str, OUTPATH: str) -> List[str]:
+    """
+    Run DIAMOND blastp once for every query genome against a single target DB and
+    demultiplex the hits into the usual per-pair hierarchical output files.
+    Loading the target DB once per batch instead of once per pair is the main saving.
+    """
     global RANK, BVBRC_GENOME_TO_TAXID # Access the global map
-    
-    try:
-        query_genome_id, target_tax_id = pair[0], str(pair[1])
-        
-        # 1. Determine the BVBRC Taxon ID for the query genome
+
+    results = []
+    target_tax_id = str(target_tax_id)
+
+    # 1. Determine the output path of every (query, target) pair in this batch
+    # Output: OUTPATH/BVBRC_TAXON_ID/QUERY_ID_TARGET_ID.tsv
+    # (the species directories were created by Rank 0 in Phase 1)
+    out_paths, query_fastas = {}, {}
+    for query_genome_id in query_genome_ids:
         bvbrc_taxon_id = BVBRC_GENOME_TO_TAXID.get(query_genome_id)
         if not bvbrc_taxon_id:
-            return f"[Rank {RANK}] ERROR: BVBRC Taxon ID not found for {query_genome_id} in the map. Skipping."
-            
-        # 2. Define the hierarchical output path
-        # Output: OUTPATH/BVBRC_TAXON_ID/QUERY_ID_TARGET_ID.tsv
-        species_out_dir = os.path.join(OUTPATH, bvbrc_taxon_id)
-        out_file = f'{query_genome_id}_{target_tax_id}.tsv'
-        full_out_path = os.path.join(species_out_dir, out_file)
-        
-        # Create the species-specific output directory
-        # Since this runs on all ranks, only the ranks assigned tasks for a given
-        # BVBRC Taxon ID will create that specific folder. This is safe with os.makedirs(exist_ok=True)
-        os.makedirs(species_out_dir, exist_ok=True)
+            results.append(f"[Rank {RANK}] ERROR: BVBRC Taxon ID not found for {query_genome_id} in the map. Skipping.")
+            continue
+        # A missing query FASTA only drops its own pair, not the whole batch
+        query_fasta = f'{QPATH}/{query_genome_id}_nonredundant.faa'
+        if not os.path.isfile(query_fasta):
+            results.append(f"[Rank {RANK}] ERROR: Query FASTA not found for {query_genome_id}: {query_fasta}. Skipping.")
+            continue
+        query_fastas[query_genome_id] = query_fasta
+        out_paths[query_genome_id] = os.path.join(OUTPATH, bvbrc_taxon_id, f'{query_genome_id}_{target_tax_id}.tsv')
+    if not out_paths:
+        return results
+
+    tmp_query = tmp_out = None
+    try:
+        # 2. Concatenate the query FASTAs, tagging each protein ID with its genome
+        with tempfile.NamedTemporaryFile("w", suffix=".faa", dir=OUTPATH, delete=False) as fh:
+            tmp_query = fh.name
+            for query_genome_id, query_fasta in query_fastas.items():
+                line = "\n"
+                with open(query_fasta) as qh:
+                    for line in qh:
+                        if line.startswith(">"):
+                            line = f">{query_genome_id}{QUERY_TAG_SEP}{line[1:]}"
+                        fh.write(line)
+                # Keep the next genome's first header off this file's last line
+                if not line.endswith("\n"):
+                    fh.write("\n")
+        tmp_out = tmp_query[:-len(".faa")] + ".tsv"
 
         # 3. Define DIAMOND command
         cmd = [
             "/path to diamond/diamond", "blastp",
-            "-q", f'{QPATH}/{query_genome_id}_nonredundant.faa',
+            "-q", tmp_query,
             "-d", f'{TPATH}/{target_tax_id}', 
-            "-o", full_out_path,
+            "-o", tmp_out,
             "-f", "6", "-k", "1", "--evalue", "1e6", "--header"
         ]
         
-        print(f"[Rank {RANK}] Submitting: {' '.join(cmd)}")
+        print(f"[Rank {RANK}] Submitting ({len(out_paths)} queries): {' '.join(cmd)}")
         
         subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
-        
-        return full_out_path 
+
+        # 4. Split hits by query genome, restoring the original protein IDs.
+        # Each pair is written to a temporary name first so an interrupted split
+        # never leaves a partial file that a restart would treat as done.
+        # DIAMOND writes hits in query input order, so one output file is open at
+        # a time and is switched when the genome prefix changes; a genome seen
+        # again later is reopened in append mode rather than truncated.
+        header, written = [], set()
+        current, h = None, None
+        try:
+            with open(tmp_out) as oh:
+                for line in oh:
+                    if line.startswith("#"):
+                        header.append(line)
+                        continue
+                    query_genome_id, _, rest = line.partition(QUERY_TAG_SEP)
+                    if query_genome_id != current:
+                        if h:
+                            h.close()
+                        seen = query_genome_id in written
+                        h = open(out_paths[query_genome_id] + ".part", "a" if seen else "w")
+                        if not seen:
+                            h.writelines(header)
+                            written.add(query_genome_id)
+                        current = query_genome_id
+                    h.write(rest)
+        finally:
+            if h:
+                h.close()
+        # Query genomes without any hit still get a (header-only) file
+        for query_genome_id, p in out_paths.items():
+            if query_genome_id not in written:
+                with open(p + ".part", "w") as h:
+                    h.writelines(header)
+        for p in out_paths.values():
+            os.replace(p + ".part", p)
+        results.extend(out_paths.values())
         
     except subprocess.CalledProcessError as e:
-        return f"[Rank {RANK}] ERROR: DIAMOND failed for pair {pair}. Exit code: {e.returncode}"
+        results.append(f"[Rank {RANK}] ERROR: DIAMOND failed for target {target_tax_id} "
+                       f"({len(out_paths)} queries). Exit code: {e.returncode}")
     except Exception as e:
-        return f"[Rank {RANK}] ERROR: An unexpected error occurred for pair {pair}: {e}"
+        results.append(f"[Rank {RANK}] ERROR: An unexpected error occurred for target {target_tax_id}: {e}")
+    finally:
+        # .part files are only left behind when the split failed partway
+        for tmp in [tmp_query, tmp_out] + [p + ".part" for p in out_paths.values()]:
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+    return results
 
 
 # --- Main MPI Workflow ---
@@ -144,37 +315,48 @@ def run_main_workflow_parallel_diamond(QPATH: str, TPATH: str, OUTPATH: str):
             all_diamond_tasks.extend(list(product(df_ids, string_ids)))
 
         print(f"[Rank 0] Generated {len(all_diamond_tasks)} total DIAMOND tasks.")
+
+        # Create every species output directory once, before any task is scattered
+        out_dirs = {os.path.join(OUTPATH, BVBRC_GENOME_TO_TAXID[g])
+                    for g, _ in all_diamond_tasks if g in BVBRC_GENOME_TO_TAXID}
+        for out_dir in out_dirs:
+            os.makedirs(out_dir, exist_ok=True)
+
+        # Skip pairs whose output already exists so that restarts are idempotent
+        n_before = len(all_diamond_tasks)
+        all_diamond_tasks = [(g, t) for g, t in all_diamond_tasks
+                             if g not in BVBRC_GENOME_TO_TAXID
+                             or not os.path.exists(os.path.join(OUTPATH, BVBRC_GENOME_TO_TAXID[g], f'{g}_{t}.tsv'))]
+        print(f"[Rank 0] Created {len(out_dirs)} output directories; "
+              f"skipping {n_before - len(all_diamond_tasks)} tasks with existing output.")
+
+        # Order tasks by target DB so each rank receives runs of pairs sharing a
+        # target and can batch all of its queries into a single DIAMOND call
+        all_diamond_tasks.sort(key=lambda p: str(p[1]))
         
         # 5. Calculate workload distribution
         N_diamond = len(all_diamond_tasks)
         avg_d, rem_d = divmod(N_diamond, SIZE)
         counts_d = [avg_d + 1 if i < rem_d else avg_d for i in range(SIZE)]
-        displs_d = [sum(counts_d[:i]) for i in range(SIZE)]
-        
-        task_slices_d = []
-        for i in range(SIZE):
-            start = displs_d[i]
-            end = displs_d[i] + counts_d[i]
-            task_slices_d.append(all_diamond_tasks[start:end])
     else:
-        task_slices_d = None
+        counts_d = None
         
-    # 6. Scatter the DIAMOND tasks
-    local_diamond_pairs = COMM.scatter(task_slices_d, root=0)
+    # 6. Scatter the DIAMOND tasks (contiguous chunks, counts_d[i] pairs per rank)
+    local_diamond_pairs = scatterv_pairs(all_diamond_tasks, counts_d)
     
     # 7. Broadcast the BVBRC Genome ID -> Taxon ID map
-    # This sends the populated dictionary from Rank 0 to all other ranks, 
-    # updating their global BVBRC_GENOME_TO_TAXID variable.
-    BVBRC_GENOME_TO_TAXID = COMM.bcast(BVBRC_GENOME_TO_TAXID, root=0)
+    # Keys and values are sent as two typed byte arrays into node-shared memory,
+    # so each node holds a single copy that all of its ranks look up from.
+    BVBRC_GENOME_TO_TAXID = share_string_map(BVBRC_GENOME_TO_TAXID)
 
     # ----------------------------------------------------
     # PHASE 2: Parallel DIAMOND Runs (All ranks)
     # ----------------------------------------------------
     
-    if local_diamond_pairs:
-        for pair in local_diamond_pairs:
-            # The run_diamond_single_pair function now relies on the global map
-            result = run_diamond_single_pair(pair, QPATH, TPATH, OUTPATH)
+    # Pairs arrive sorted by target, so consecutive pairs form one batch per target DB
+    for target_tax_id, batch in groupby(local_diamond_pairs, key=lambda p: p[1]):
+        # The run_diamond_target_batch function relies on the global map
+        for result in run_diamond_target_batch(target_tax_id, [g for g, _ in batch], QPATH, TPATH, OUTPATH):
             print(result) 
 
     # Wait for all DIAMOND runs to complete before exiting
@@ -1,16 +1,21 @@
 import os
 import glob
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 # replace location to installation with your diamond path
 
-def create_diamond_db(input_dir: str, output_dir: str = 'NewBVBRC_db'):
+def create_diamond_db(input_dir: str, output_dir: str = 'NewBVBRC_db', max_workers: int = None):
     """
     Creates a Diamond protein database from all .faa (protein FASTA) 
     files in the specified directory.
+
+    Each makedb runs single-threaded and up to max_workers run concurrently
+    (default: all cores), since every database build is independent.
     
     Args:
         input_dir (str): Path to the folder containing the strain .faa files.
+        max_workers (int): Number of concurrent makedb processes.
     """
     
     # Find all protein FASTA files (.faa)
@@ -20,28 +25,36 @@ def create_diamond_db(input_dir: str, output_dir: str = 'NewBVBRC_db'):
         print(f"Error: No protein FASTA files (.faa) found in {input_dir}")
         return
     created_dbs = []
-    for fasta_path in protein_files:
-        # Determine the base name for the database (e.g., 'StrainA' from 'StrainA.faa')
-        fasta_basename = os.path.basename(fasta_path)
-        db_name = os.path.splitext(fasta_basename)[0] 
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as ex:
+        futures = {}
+        for fasta_path in protein_files:
+            # Determine the base name for the database (e.g., 'StrainA' from 'StrainA.faa')
+            fasta_basename = os.path.basename(fasta_path)
+            db_name = os.path.splitext(fasta_basename)[0] 
 
-        print(f"\t-->Creating database for: {fasta_basename}")
-        try:
+            print(f"\t-->Creating database for: {fasta_basename}")
             command = [
                 "/location to installation/diamond", "makedb", 
                 "--in", fasta_path, 
-                "-d", os.path.join(output_dir, db_name)
+                "-d", os.path.join(output_dir, db_name),
+                "--threads", "1"
             ] 
-            # Execute the command
-            # Note: subprocess.run is typically used, but the original logic is preserved.
-            subprocess.run(command, check=True, capture_output=True, text=True)
-            print(f"  -> Success: {db_name}.dmnd created.")
-            created_dbs.append(db_name)
-        except subprocess.CalledProcessError as e:
-            print(f"  -> Error running Diamond makedb for {fasta_basename}: {e.stderr}")
-        except FileNotFoundError:
-            print("Error: Diamond command not found. Make sure Diamond is in your PATH.")
-            return []
+            # Threads are enough here: the Python side only waits on the subprocess
+            futures[ex.submit(subprocess.run, command, check=True, capture_output=True, text=True)] = (fasta_basename, db_name)
+
+        for fut in as_completed(futures):
+            fasta_basename, db_name = futures[fut]
+            try:
+                fut.result()
+                print(f"  -> Success: {db_name}.dmnd created.")
+                created_dbs.append(db_name)
+            except subprocess.CalledProcessError as e:
+                print(f"  -> Error running Diamond makedb for {fasta_basename}: {e.stderr}")
+            except FileNotFoundError:
+                print("Error: Diamond command not found. Make sure Diamond is in your PATH.")
+                for pending in futures:
+                    pending.cancel()
+                return []
     return created_dbs
 
 if __name__=='__main__':
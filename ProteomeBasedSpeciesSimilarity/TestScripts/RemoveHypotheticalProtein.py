@@ -1,16 +1,28 @@
 ##Author: Gopal Srivastava
 ## The script uses a fasta file as input and removes the hypothetical or undefined proteins from the fasta file
 
-from Bio import SeqIO
 import re
-import os, sys, argparse
+import os, sys, argparse, shutil, tempfile
 
 def parseFasta(inputfile, type):
-  sequences = SeqIO.parse(f'{inputfile}', 'fasta')
-  filtered = [seq for seq in sequences if f'{type}' not in seq.description]
-
-  with open(f'{inputfile}', 'wt') as output:
-    SeqIO.write(filtered, output, 'fasta')
+  # Byte-level scan: a header decides whether it and its sequence lines are kept.
+  # Output goes to a temp file next to the input and then replaces it atomically.
+  needle = f'{type}'.encode()
+  keep = True
+  tmp = tempfile.NamedTemporaryFile('wb', delete=False,
+                                    dir=os.path.dirname(os.path.abspath(inputfile)))
+  try:
+    with open(f'{inputfile}', 'rb') as handle, tmp:
+      for line in handle:
+        if line.startswith(b'>'):
+          keep = needle not in line
+        if keep:
+          tmp.write(line)
+    shutil.copymode(inputfile, tmp.name)
+    os.replace(tmp.name, inputfile)
+  except BaseException:
+    os.unlink(tmp.name)
+    raise
 
 def main():
   ap = argparse.ArgumentParser(description="Fetch protein FASTA from BV-BRC genome_feature with filters.")
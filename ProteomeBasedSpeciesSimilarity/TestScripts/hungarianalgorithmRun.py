@@ -2,17 +2,66 @@
 
 import argparse, math
 from typing import Optional, Dict, Tuple, List
+import numpy as np
 import pandas as pd
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import bmat, csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+try:
+    from lap import lapjv
+except ImportError:  # lap is optional; SciPy is used otherwise
+    lapjv = None
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the "numba" solver is unavailable without it
+    njit = None
+
+try:
+    import polars as pl
+except ImportError:  # polars is optional; the pandas pipeline is used otherwise
+    pl = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:  # pyarrow is optional; fall back to the pandas parser
+    pa = None
 
 COLS = ["qseqid","sseqid","pident","length","qlen","slen",
         "qstart","qend","sstart","send","evalue","bitscore"]
+KEEP = ["qseqid","sseqid","pident","length","evalue","bitscore"]
+DIR_COLS = ["qseqid","sseqid","bitscore","pident","length","evalue"]
+OUT_COLS = ["qseqid","sseqid","bitscore","score","pident_a2b","pident_b2a",
+            "avg_pident","length","evalue"]
+
+def _read_outfmt6_arrow(path: str) -> pd.DataFrame:
+    """Parse and type-check outfmt6 in one pass with Arrow's multithreaded CSV reader."""
+    tbl = pacsv.read_csv(
+        path,
+        read_options=pacsv.ReadOptions(column_names=COLS),
+        parse_options=pacsv.ParseOptions(delimiter="\t"),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=KEEP,
+            column_types={"qseqid": pa.string(), "sseqid": pa.string(),
+                          "pident": pa.float64(), "length": pa.int64(),
+                          "evalue": pa.float64(), "bitscore": pa.float64()}),
+    )
+    return tbl.to_pandas()
 
 def read_outfmt6(path: str) -> pd.DataFrame:
-    df = pd.read_csv(path, sep="\t", header=None, names=COLS,
-                     usecols=["qseqid","sseqid","pident","length","evalue","bitscore"])
-    for c in ["pident","length","evalue","bitscore"]:
-        df[c] = pd.to_numeric(df[c], errors="coerce")
+    df = None
+    if pa is not None:
+        try:
+            df = _read_outfmt6_arrow(path)
+        except pa.ArrowInvalid:
+            # Non-numeric fields (e.g. "# DIAMOND" header lines): use the coercing reader
+            df = None
+    if df is None:
+        df = pd.read_csv(path, sep="\t", header=None, names=COLS, usecols=KEEP)
+        for c in ["pident","length","evalue","bitscore"]:
+            df[c] = pd.to_numeric(df[c], errors="coerce")
     df = df.dropna(subset=["length","evalue","bitscore"]).reset_index(drop=True)
     return df
 
@@ -20,8 +69,9 @@ def collapse_max_bitscore(df: pd.DataFrame) -> pd.DataFrame:
     """Keep the row with max bitscore for each (qseqid, sseqid)."""
     if df.empty:
         return df
-    idx = df.groupby(["qseqid","sseqid"])["bitscore"].idxmax()
-    return df.loc[idx].reset_index(drop=True)
+    # Hash-based max per group + first-occurrence dedup: same row as idxmax, no sorted gather
+    best = df["bitscore"] == df.groupby(["qseqid","sseqid"], sort=False)["bitscore"].transform("max")
+    return df[best].drop_duplicates(["qseqid","sseqid"]).reset_index(drop=True)
 
 def to_dir_dict(df: pd.DataFrame, flip: bool,
                 emax: Optional[float], Lmin: Optional[int]) -> Dict[Tuple[str,str], dict]:
@@ -29,115 +79,265 @@ def to_dir_dict(df: pd.DataFrame, flip: bool,
     Return dict: (A,B) -> best row dict incl. bitscore/pident/length/evalue.
     If flip=True, store as (sseqid,qseqid) so both files key as (A,B).
     """
-    D: Dict[Tuple[str,str], dict] = {}
-    for _, r in df.iterrows():
-        if Lmin is not None and r.length < Lmin:
-            continue
-        if emax  is not None and r.evalue > emax:
-            continue
-        A, B = (r.sseqid, r.qseqid) if flip else (r.qseqid, r.sseqid)
-        key = (A, B)
-        prev = D.get(key)
-        if prev is None or r.bitscore > prev["bitscore"]:
-            D[key] = {
-                "qseqid": A,
-                "sseqid": B,
-                "bitscore": float(r.bitscore),
-                "pident": float(r.pident) if pd.notna(r.pident) else float("nan"),
-                "length": float(r.length),
-                "evalue": float(r.evalue),
-            }
-    return D
-
-def _avg_two(a: Optional[float], b: Optional[float]) -> float:
-    """Average two numbers if both are finite; otherwise return the finite one, else NaN."""
-    a_ok = a is not None and not pd.isna(a)
-    b_ok = b is not None and not pd.isna(b)
-    if a_ok and b_ok:
-        return 0.5*(a+b)
-    if a_ok:
-        return a
-    if b_ok:
-        return b
-    return float("nan")
+    mask = pd.Series(True, index=df.index)
+    if Lmin is not None:
+        mask &= df["length"] >= Lmin
+    if emax is not None:
+        mask &= df["evalue"] <= emax
+    df = df.loc[mask, DIR_COLS]
+    if df.empty:
+        return {}
+    if flip:
+        df = df.rename(columns={"qseqid": "sseqid", "sseqid": "qseqid"})
+    df = df.astype({"bitscore": float, "pident": float, "length": float, "evalue": float})
+    best = df.loc[df.groupby(["qseqid","sseqid"], sort=False)["bitscore"].idxmax(), DIR_COLS]
+    return best.set_index(["qseqid","sseqid"], drop=False).to_dict("index")
+
+def _load_dir_dict_polars(path: str, flip: bool,
+                          emax: Optional[float], Lmin: Optional[int]) -> Dict[Tuple[str,str], dict]:
+    """
+    read_outfmt6 + collapse_max_bitscore + to_dir_dict as one lazy Polars plan:
+    parsing, the per-pair max-bitscore pick and the filters run in a single
+    multithreaded pass and the result is materialized once.
+    """
+    schema = {c: pl.Utf8 for c in COLS}
+    schema.update({"pident": pl.Float64, "length": pl.Int64,
+                   "evalue": pl.Float64, "bitscore": pl.Float64})
+    lf = (pl.scan_csv(path, separator="\t", has_header=False, comment_prefix="#", schema=schema)
+            .select(KEEP)
+            .drop_nulls(["length","evalue","bitscore"])
+            # same row as collapse_max_bitscore: first row with the pair's max bitscore
+            .filter(pl.col("bitscore") == pl.col("bitscore").max().over(["qseqid","sseqid"]))
+            .unique(subset=["qseqid","sseqid"], keep="first", maintain_order=True))
+    if Lmin is not None:
+        lf = lf.filter(pl.col("length") >= Lmin)
+    if emax is not None:
+        lf = lf.filter(pl.col("evalue") <= emax)
+    if flip:
+        lf = lf.rename({"qseqid": "sseqid", "sseqid": "qseqid"})
+    lf = lf.select(pl.col("qseqid"), pl.col("sseqid"), pl.col("bitscore"),
+                   pl.col("pident").fill_null(float("nan")),
+                   pl.col("length").cast(pl.Float64), pl.col("evalue"))
+    return {(r["qseqid"], r["sseqid"]): r for r in lf.collect().iter_rows(named=True)}
+
+def load_dir_dict(path: str, flip: bool,
+                  emax: Optional[float], Lmin: Optional[int]) -> Dict[Tuple[str,str], dict]:
+    """Directional best-hit dict for one outfmt6 file; uses Polars when installed."""
+    if pl is not None:
+        try:
+            return _load_dir_dict_polars(path, flip, emax, Lmin)
+        except pl.exceptions.PolarsError:
+            # Malformed or empty input: let the coercing pandas reader handle or report it
+            pass
+    df = collapse_max_bitscore(read_outfmt6(path))
+    return to_dir_dict(df, flip=flip, emax=emax, Lmin=Lmin)
 
 def merge_symmetric(a2b: dict, b2a: dict, how: str = "avg"):
     """
     Merge directional dicts into a symmetric record per (A,B).
     Adds pident_a2b, pident_b2a, and avg_pident to each record.
+    Both directions are outer-joined once and every field is picked with
+    vectorized masks; records are materialized only when returning.
     """
-    merged = {}
-    keys = set(a2b) | set(b2a)
-    for k in keys:
-        v1, v2 = a2b.get(k), b2a.get(k)  # v1 from A->B file, v2 from B->A file (flipped)
-        if v1 and v2:
-            if how == "max":
-                chosen = v1 if v1["bitscore"] >= v2["bitscore"] else v2
-                score = max(v1["bitscore"], v2["bitscore"])
-            elif how == "min":
-                chosen = v1 if v1["bitscore"] <= v2["bitscore"] else v2
-                score = min(v1["bitscore"], v2["bitscore"])
-            else:  # avg
-                chosen = v1 if v1["bitscore"] >= v2["bitscore"] else v2
-                score = 0.5*(v1["bitscore"] + v2["bitscore"])
-            rec = chosen.copy()
-            rec["score"] = score
-            # add directional pidents
-            rec["pident_a2b"] = float(v1["pident"])
-            rec["pident_b2a"] = float(v2["pident"])
-            rec["avg_pident"] = _avg_two(rec["pident_a2b"], rec["pident_b2a"])
-            merged[k] = rec
-        else:
-            # Only one side present
-            only = (v1 or v2).copy()
-            only["score"] = only["bitscore"]
-            if v1:  # came from A->B
-                only["pident_a2b"] = float(v1["pident"])
-                only["pident_b2a"] = float("nan")
-            else:   # came from B->A
-                only["pident_a2b"] = float("nan")
-                only["pident_b2a"] = float(v2["pident"])
-            only["avg_pident"] = _avg_two(only["pident_a2b"], only["pident_b2a"])
-            merged[k] = only
-    return merged
+    fa = pd.DataFrame(list(a2b.values()), columns=DIR_COLS)  # from A->B file
+    fb = pd.DataFrame(list(b2a.values()), columns=DIR_COLS)  # from B->A file (flipped)
+    m = fa.merge(fb, on=["qseqid","sseqid"], how="outer", suffixes=("_a2b", "_b2a"))
+    if m.empty:
+        return {}
+    bs1, bs2 = m["bitscore_a2b"].to_numpy(float), m["bitscore_b2a"].to_numpy(float)
+    has1, has2 = ~np.isnan(bs1), ~np.isnan(bs2)
+    with np.errstate(invalid="ignore"):
+        if how == "min":
+            take1 = has1 & (~has2 | (bs1 <= bs2))
+            score = np.fmin(bs1, bs2)
+        else:  # avg / max both keep the record with the higher bitscore
+            take1 = has1 & (~has2 | (bs1 >= bs2))
+            score = np.fmax(bs1, bs2)
+            if how == "avg":
+                both = has1 & has2
+                score[both] = 0.5*(bs1[both] + bs2[both])
+
+    out = m[["qseqid","sseqid"]].copy()
+    for c in ["bitscore","pident","length","evalue"]:
+        out[c] = np.where(take1, m[f"{c}_a2b"].to_numpy(float), m[f"{c}_b2a"].to_numpy(float))
+    out["score"] = score
+    # add directional pidents; the average falls back to whichever side is finite
+    out["pident_a2b"] = m["pident_a2b"].astype(float)
+    out["pident_b2a"] = m["pident_b2a"].astype(float)
+    out["avg_pident"] = out[["pident_a2b","pident_b2a"]].mean(axis=1)
+    return out.set_index(["qseqid","sseqid"], drop=False).to_dict("index")
 
 def build_cost_matrix(merged: dict):
-    """Return queries, targets, score_matrix, cost_matrix (cost = max_score - score)."""
+    """
+    Return queries, targets, score_matrix, cell records and the max score.
+    The score matrix is a sparse CSR matrix holding only the positive scores.
+    """
     queries = sorted({k[0] for k in merged})
     targets = sorted({k[1] for k in merged})
     qi = {q:i for i,q in enumerate(queries)}
     ti = {t:i for i,t in enumerate(targets)}
     n, m = len(queries), len(targets)
-    score = [[0.0 for _ in range(m)] for __ in range(n)]
-    cell = {}
-    max_score = 0.0
-    for (A,B), rec in merged.items():
-        i, j = qi[A], ti[B]
-        s = rec["score"]
-        if s > score[i][j]:
-            score[i][j] = s
-            cell[(i,j)] = rec
-        if s > max_score:
-            max_score = s
-    cost = [[(max_score - score[i][j]) for j in range(m)] for i in range(n)]
-    return queries, targets, score, cost, cell, max_score
-
-def solve_hungarian(cost, transpose_if_needed=True):
+    keys = list(merged)
+    ii = np.fromiter((qi[k[0]] for k in keys), dtype=np.intp, count=len(keys))
+    jj = np.fromiter((ti[k[1]] for k in keys), dtype=np.intp, count=len(keys))
+    ss = np.fromiter((merged[k]["score"] for k in keys), dtype=np.float64, count=len(keys))
+    # (A,B) keys are unique, so every cell is written at most once
+    pos = ss > 0.0
+    score = csr_matrix((ss[pos], (ii[pos], jj[pos])), shape=(n, m))
+    cell = {(i, j): merged[k] for i, j, s, k in zip(ii.tolist(), jj.tolist(), ss.tolist(), keys) if s > 0.0}
+    max_score = max(float(ss.max()), 0.0) if len(ss) else 0.0
+    return queries, targets, score, cell, max_score
+
+def _lsap_min(cost):
     """
-    SciPy’s linear_sum_assignment minimizes over rows. If rows>cols, transpose so it can assign.
-    Returns (row_idx, col_idx, transposed_flag).
+    Shortest augmenting path Jonker-Volgenant (the variant SciPy implements) on a
+    C-contiguous float64 cost matrix with rows <= cols. Returns col4row.
+    Written with scalar loops over preallocated arrays so numba can compile it.
     """
-    n, m = len(cost), (len(cost[0]) if cost else 0)
-    transposed = False
-    if transpose_if_needed and n > m:
-        # transpose to shape (m, n)
-        tcost = list(map(list, zip(*cost)))
-        col_ind, row_ind = linear_sum_assignment(tcost)  # swapped
-        transposed = True
-        return row_ind, col_ind, transposed
-    else:
-        row_ind, col_ind = linear_sum_assignment(cost)
-        return row_ind, col_ind, transposed
+    nr, nc = cost.shape
+    u = np.zeros(nr)
+    v = np.zeros(nc)
+    shortest = np.empty(nc)
+    path = np.full(nc, -1)
+    col4row = np.full(nr, -1)
+    row4col = np.full(nc, -1)
+    SR = np.zeros(nr, dtype=np.bool_)
+    SC = np.zeros(nc, dtype=np.bool_)
+    remaining = np.empty(nc, dtype=np.int64)
+
+    for cur_row in range(nr):
+        # Dijkstra-like search for the shortest augmenting path from cur_row
+        min_val = 0.0
+        num_remaining = nc
+        for it in range(nc):
+            remaining[it] = nc - it - 1
+        SR[:] = False
+        SC[:] = False
+        shortest[:] = np.inf
+        sink = -1
+        i = cur_row
+        while sink == -1:
+            index = -1
+            lowest = np.inf
+            SR[i] = True
+            for it in range(num_remaining):
+                j = remaining[it]
+                r = min_val + cost[i, j] - u[i] - v[j]
+                if r < shortest[j]:
+                    path[j] = i
+                    shortest[j] = r
+                if shortest[j] < lowest or (shortest[j] == lowest and row4col[j] == -1):
+                    lowest = shortest[j]
+                    index = it
+            min_val = lowest
+            if min_val == np.inf:
+                raise ValueError("cost matrix is infeasible")
+            j = remaining[index]
+            if row4col[j] == -1:
+                sink = j
+            else:
+                i = row4col[j]
+            SC[j] = True
+            num_remaining -= 1
+            remaining[index] = remaining[num_remaining]
+
+        # update dual variables
+        u[cur_row] += min_val
+        for i in range(nr):
+            if SR[i] and i != cur_row:
+                u[i] += min_val - shortest[col4row[i]]
+        for j in range(nc):
+            if SC[j]:
+                v[j] -= min_val - shortest[j]
+
+        # augment along the path back to cur_row
+        j = sink
+        while True:
+            i = path[j]
+            row4col[j] = i
+            prev = col4row[i]
+            col4row[i] = j
+            j = prev
+            if i == cur_row:
+                break
+    return col4row
+
+if njit is not None:
+    _lsap_min = njit(cache=True)(_lsap_min)
+
+def _solve_numba(score: np.ndarray):
+    """Maximize score with the numba-compiled _lsap_min kernel. Returns (row_idx, col_idx)."""
+    transpose = score.shape[0] > score.shape[1]
+    cost = np.ascontiguousarray(-(score.T if transpose else score), dtype=np.float64)
+    col4row = _lsap_min(cost)
+    rows = np.arange(len(col4row))
+    if transpose:
+        order = np.argsort(col4row)
+        return col4row[order], rows[order]
+    return rows, col4row
+
+def _solve_dense(score: np.ndarray, solver: str):
+    """
+    Maximize the total score of a one-to-one assignment on a dense matrix.
+    solver="lapjv" uses lap.lapjv (faster on large dense matrices) on the
+    equivalent cost matrix max(score) - score; solver="scipy" uses
+    linear_sum_assignment, which handles rectangular matrices directly.
+    solver="numba" runs the numba-compiled _lsap_min kernel.
+    Returns (row_idx, col_idx).
+    """
+    if solver == "lapjv" and score.size:
+        cost = score.max() - score
+        _, x, _ = lapjv(cost, extend_cost=True)
+        rows = np.flatnonzero(x >= 0)
+        return rows, x[rows].astype(np.intp)
+    if solver == "numba" and score.size:
+        return _solve_numba(score)
+    return linear_sum_assignment(score, maximize=True)
+
+def resolve_solver(solver: str) -> str:
+    """Map "auto" to lapjv when the lap package is installed, else SciPy."""
+    if solver == "auto":
+        return "lapjv" if lapjv is not None else "scipy"
+    return solver
+
+def solve_hungarian(score: csr_matrix, solver: str = "auto"):
+    """
+    Maximize the total score of a one-to-one assignment over a sparse score matrix.
+    Rows and columns only interact through non-zero scores, so the bipartite hit
+    graph is split into connected components and each component is solved as a
+    small dense problem with _solve_dense. Zero cells are never materialized.
+    "auto" is resolved with resolve_solver.
+    Returns (row_idx, col_idx) sorted by row.
+    """
+    solver = resolve_solver(solver)
+    n, m = score.shape
+    if score.nnz == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    adj = bmat([[None, score], [score.T, None]], format="csr")
+    ncomp, labels = connected_components(adj, directed=False)
+    r_order = np.argsort(labels[:n], kind="stable")
+    c_order = np.argsort(labels[n:], kind="stable")
+    r_bounds = np.searchsorted(labels[:n][r_order], np.arange(ncomp + 1))
+    c_bounds = np.searchsorted(labels[n:][c_order], np.arange(ncomp + 1))
+
+    rows, cols = [], []
+    for k in range(ncomp):
+        R = r_order[r_bounds[k]:r_bounds[k + 1]]
+        C = c_order[c_bounds[k]:c_bounds[k + 1]]
+        if len(R) == 0 or len(C) == 0:  # row or column without any hit
+            continue
+        sub = score[R][:, C].toarray()
+        if len(R) == 1 or len(C) == 1:
+            flat = int(np.argmax(sub))
+            r, c = np.array([flat // len(C)]), np.array([flat % len(C)])
+        else:
+            r, c = _solve_dense(sub, solver)
+        rows.append(R[r])
+        cols.append(C[c])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    order = np.argsort(rows)
+    return rows[order], cols[order]
 
 def main():
     ap = argparse.ArgumentParser(description="Symmetric BLAST merge on bitscore, Hungarian via SciPy (with directional pidents).")
@@ -149,38 +349,26 @@ def main():
                     help="merge both directions by avg/max/min bitscore")
     ap.add_argument("--emax", type=float, default=1e-3, help="keep HSPs with E <= emax")
     ap.add_argument("--Lmin", type=int, default=30, help="keep HSPs with alignment length >= Lmin")
+    ap.add_argument("--solver", choices=["auto","scipy","lapjv","numba"], default="auto",
+                    help="assignment solver; auto uses lap.lapjv when installed, else SciPy")
     args = ap.parse_args()
+    if args.solver == "lapjv" and lapjv is None:
+        ap.error("--solver lapjv requires the 'lap' package")
+    if args.solver == "numba" and njit is None:
+        ap.error("--solver numba requires the 'numba' package")
+    solver = resolve_solver(args.solver)
 
-    A = collapse_max_bitscore(read_outfmt6(args.a2b))
-    B = collapse_max_bitscore(read_outfmt6(args.b2a))
-    dA = to_dir_dict(A, flip=False, emax=args.emax, Lmin=args.Lmin)   # A->B
-    dB = to_dir_dict(B, flip=True,  emax=args.emax, Lmin=args.Lmin)   # B->A (flipped to A,B keys)
+    dA = load_dir_dict(args.a2b, flip=False, emax=args.emax, Lmin=args.Lmin)   # A->B
+    dB = load_dir_dict(args.b2a, flip=True,  emax=args.emax, Lmin=args.Lmin)   # B->A (flipped to A,B keys)
     merged = merge_symmetric(dA, dB, how=args.how)
 
-    queries, targets, score, cost, cell, max_score = build_cost_matrix(merged)
-    r, c, transposed = solve_hungarian(cost, transpose_if_needed=True)
+    queries, targets, score, cell, max_score = build_cost_matrix(merged)
+    r, c = solve_hungarian(score, solver=solver)
 
-    # Collect chosen real pairs
-    chosen = []
-    n, m = len(queries), len(targets)
-    for i, j in zip(r, c):
-        ii, jj = (j, i) if transposed else (i, j)
-        if ii < n and jj < m and (ii, jj) in cell:
-            rec = cell[(ii, jj)]
-            chosen.append({
-                "qseqid": rec["qseqid"],
-                "sseqid": rec["sseqid"],
-                "bitscore": rec["bitscore"],
-                "score": rec["score"],
-                "pident_a2b": rec.get("pident_a2b", float("nan")),
-                "pident_b2a": rec.get("pident_b2a", float("nan")),
-                "avg_pident": rec.get("avg_pident", float("nan")),
-                "length": rec["length"],
-                "evalue": rec["evalue"],
-            })
-
-    out_df = pd.DataFrame(chosen)
-    out_df.to_csv(args.out, index=False)
+    # Collect chosen real pairs straight from the cell records
+    rows = [cell[p] for p in zip(r.tolist(), c.tolist()) if p in cell]
+    out_df = pd.DataFrame.from_records(rows, columns=OUT_COLS)
+    out_df.to_csv(args.out, index=False, chunksize=100_000)
 
     with open(args.summary, "w") as fh:
         fh.write(f"Unique queries: {len(queries)}\n")
@@ -189,8 +377,8 @@ def main():
         fh.write(f"Max bitscore across matrix: {max_score:.3f}\n")
         fh.write(f"Merge mode: {args.how}\n")
         fh.write(f"Filters: emax <= {args.emax}, Lmin >= {args.Lmin}\n")
-        fh.write(f"Cost = max_bitscore - score (minimized)\n")
-        fh.write(f"Transposed for LSA: {transposed}\n")
+        fh.write(f"Objective: total score (maximized)\n")
+        fh.write(f"Solver: {solver}\n")
 
     print(f"Wrote {args.out} and {args.summary}")
 
@@ -1,11 +1,19 @@
 #!/bin/python3
 # This script returns species vs species similarity matrix with diagona representing similarity between same species
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:  # pyarrow is optional; fall back to the pandas parser
+    pacsv = None
 
 # Data path
-DATA_DIR = Path(".")
+DATA_DIR = "."
 
 # Load number of sequences per species
 numberofseqs = pd.read_csv('../numberofseqs.txt', sep=':') # contains the number of sequneces per fasta file created using `grep -c ">" *.faa`
@@ -14,61 +22,80 @@ numberofseqs.Species = numberofseqs.Species.astype(str)
 # Dictionary to look up number of sequences by species ID
 seq_count = dict(zip(numberofseqs.Species, numberofseqs.NumberofSeqs))
 
-# Store results
-results = {}
-
-# Iterate over each hungarian output file (*.csv)
-for filename in DATA_DIR.glob("*.csv"):
-    fname = filename.name
+def read_avg_pident(path):
+    """Return the avg_pident column of a hungarian output file as float64, or None if absent."""
+    with open(path) as fh:
+        header = fh.readline().rstrip("\r\n").split(",")
+    if "avg_pident" not in header:
+        return None
+    if pacsv is not None:
+        tbl = pacsv.read_csv(path, convert_options=pacsv.ConvertOptions(
+            include_columns=["avg_pident"], column_types={"avg_pident": pa.float64()}))
+        return tbl.column(0).to_numpy(zero_copy_only=False)
+    return pd.read_csv(path, usecols=["avg_pident"])["avg_pident"].to_numpy(dtype=np.float64)
+
+def species_similarity(entry):
+    """Return (a, b, similarity) for one hungarian output file (os.DirEntry), or None if it is skipped."""
+    fname = entry.name
 
     # Extract species IDs
     if "_vs_" not in fname:
-        continue
+        return None
     a, b = fname.split("_vs_")
     b = b.replace(".tsv_hungarian.csv", "").replace(".tsv", "")
 
     # If same species → force similarity = 100
     if a == b:
-        results.setdefault(a, {})[b] = 100.0
-        continue
+        return a, b, 100.0
 
     # Get sequence counts
     if a not in seq_count or b not in seq_count:
         print(f"Skipping {fname}: missing seq count for {a} or {b}")
-        continue
+        return None
     na, nb = seq_count[a], seq_count[b]
 
     # Minimum number of sequences
     min_matches = min(na, nb)
 
     # Read the file and compute similarity
-    df = pd.read_csv(filename)
-    if "avg_pident" not in df.columns:
+    pident = read_avg_pident(entry.path)
+    if pident is None:
         print(f"Skipping {fname}: no pident column")
-        continue
+        return None
 
-    # If df has fewer alignments than expected, pad with zeros
-    observed = len(df)
+    # If df has fewer alignments than expected, pad with the lowest observed pident
+    observed = pident.size
+    total = np.nansum(pident)
     if observed < min_matches:
         missing = min_matches - observed
-        speciesSimilarity = (df["avg_pident"].sum() + missing * df.avg_pident.min()) / min_matches
+        lowest = np.nanmin(pident) if np.isfinite(pident).any() else np.nan
+        speciesSimilarity = (total + missing * lowest) / min_matches
     else:
-        speciesSimilarity = df["avg_pident"].sum() / min_matches
-
-    # Store in nested dict
-    results.setdefault(a, {})[b] = speciesSimilarity
-
-# Convert results to DataFrame (rows = A, cols = B)
-similarity_matrix = pd.DataFrame.from_dict(results, orient="index")
+        speciesSimilarity = total / min_matches
+    return a, b, float(speciesSimilarity)
+
+# Iterate over each hungarian output file (*.csv); os.scandir yields DirEntry
+# objects with the name already cached, and the work is I/O bound so threads suffice
+with os.scandir(DATA_DIR) as it:
+    entries = [entry for entry in it if entry.name.endswith(".csv")]
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+    found = [res for res in ex.map(species_similarity, entries) if res is not None]
+
+# Fill a preallocated species x species matrix (rows = A, cols = B)
+species = sorted({a for a, _, _ in found} | {b for _, b, _ in found})
+sp2idx = {sp: i for i, sp in enumerate(species)}
+M = np.full((len(species), len(species)), np.nan)
+for a, b, sim in found:
+    M[sp2idx[a], sp2idx[b]] = sim
 
 # --- Symmetrize: fill NaNs with transpose values ---
-similarity_matrix = similarity_matrix.combine_first(similarity_matrix.T)
+M = np.where(np.isnan(M), M.T, M)
 
 # Ensure diagonal = 100 (in case no self files existed)
-for sp in similarity_matrix.index:
-    similarity_matrix.loc[sp, sp] = 100.0
+np.fill_diagonal(M, 100.0)
 
 # Save matrix
+similarity_matrix = pd.DataFrame(M, index=species, columns=species)
 similarity_matrix.to_csv("species_similarity_matrix.csv")
 
 print("Wrote species_similarity_matrix.csv")
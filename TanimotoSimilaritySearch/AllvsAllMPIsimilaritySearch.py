@@ -6,7 +6,7 @@
 # Usage (32 ranks):
 #   mpirun -np 32 python mpi_tanimoto_allvsall.py \
 #       --in smiles.tsv \
-#       --out-matrix tanimoto_matrix.csv \
+#       --out-matrix tanimoto_matrix.npy \
 #       --out-pairs tanimoto_pairs.tsv \
 #       --pairs-thresh 0.85 \
 #       --row-batch 2000 --col-batch 2000
@@ -16,27 +16,104 @@
 # Notes:
 # - Fingerprint: Morgan radius=2, nBits=2048
 # - Invalid SMILES -> NaN in matrix
-# - Work splitting: round-robin over row batches across ranks
-# - The pairs TSV is written only on rank 0 after gathering
+# - Matrix is written as .npy (+ names file) unless --csv; --pairs-only never
+#   allocates it
+# - Work splitting: round-robin over (row batch, column batch) blocks on or
+#   above the diagonal (the matrix is symmetric)
+# - Fingerprints are computed in shards and all-gathered; blocks are
+#   sent to rank 0 with Isend as they finish; each rank writes its own pairs
+#   part file while computing and rank 0 concatenates them
+# - Pairs TSV is sorted by (i, j), except for pairs-only runs with a positive
+#   threshold, whose popcount prefilter leaves rows in popcount order
+# - Optional C kernel: build libtanimoto.so from tanimoto_avx512.c (see its
+#   header) next to this script; otherwise numba, then NumPy, is used
 
 from __future__ import annotations
 import argparse
-import math
+import ctypes
+import hashlib
+import heapq
+import io
+import logging
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
 from typing import List, Tuple
 
 import numpy as np
 import pandas as pd
+import mpi4py
+
+if __name__ == "__mp_main__":
+    # Re-imported by a spawned fingerprint worker (see fingerprint_matrix);
+    # the worker only runs RDKit and must not initialise MPI
+    mpi4py.rc.initialize = False
+    mpi4py.rc.finalize = False
 from mpi4py import MPI
 
 from rdkit import Chem, DataStructs
 from rdkit.Chem.rdFingerprintGenerator import GetMorganGenerator
 
+try:
+    from numba import njit, prange, types
+    from numba.extending import intrinsic
+except ImportError:  # numba is optional; compute_block falls back to NumPy
+    njit = None
+
 
 # ---------- MPI setup ----------
-comm = MPI.COMM_WORLD
-rank = comm.Get_rank()
-size = comm.Get_size()
+if MPI.Is_initialized():
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    # Ranks sharing this node, for sizing the per-rank fingerprint pool
+    NODE_COMM = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    node_size = NODE_COMM.Get_size()
+else:  # spawned fingerprint worker
+    comm = NODE_COMM = None
+    rank, size, node_size = 0, 1, 1
+
+
+def bcast_strings(names: List[str], smiles: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    Broadcast rank 0's names and SMILES as one NUL-separated UTF-8 buffer
+    with typed Bcast calls (no pickling); every other rank passes None.
+    """
+    if rank == 0:
+        buf = np.frombuffer("\0".join(names + smiles).encode(), dtype=np.uint8)
+        sz = np.array([len(names), buf.size], dtype=np.int64)
+    else:
+        sz = np.empty(2, dtype=np.int64)
+    comm.Bcast([sz, MPI.INT64_T], root=0)
+    n, nbytes = int(sz[0]), int(sz[1])
+    if rank != 0:
+        buf = np.empty(nbytes, dtype=np.uint8)
+    comm.Bcast([buf, MPI.BYTE], root=0)
+    if rank == 0:
+        return names, smiles
+    parts = buf.tobytes().decode().split("\0") if n else []
+    return parts[:n], parts[n:]
+
+
+# Per-block progress; only emitted with --verbose
+log = logging.getLogger("tanimoto")
+
+
+class BufferedStderrHandler(logging.StreamHandler):
+    """
+    StreamHandler writing to a block-buffered stderr without flushing after
+    every record; the buffer is written out when logging shuts down at exit.
+    """
+    def __init__(self):
+        super().__init__(io.TextIOWrapper(open(2, "wb", closefd=False)))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.stream.flush()
+        super().close()
 
 
 # ---------- Args ----------
@@ -44,39 +121,58 @@ def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument("--in", dest="infile", required=True,
                    help="Input TSV/CSV with columns: name, canonical_smiles (or SMILES)")
-    p.add_argument("--out-matrix", required=True,
-                   help="Output CSV of symmetric Tanimoto matrix (names as header/index)")
+    p.add_argument("--out-matrix", default=None,
+                   help="Output .npy of the symmetric Tanimoto matrix, with names in <out>.names.txt "
+                        "(or a CSV with names as header/index when --csv is given)")
+    p.add_argument("--csv", action="store_true",
+                   help="Write --out-matrix as CSV instead of .npy")
+    p.add_argument("--pairs-only", action="store_true",
+                   help="Only write --out-pairs; the n x n matrix is never allocated")
     p.add_argument("--out-pairs", default=None,
-                   help="Optional output TSV of (i,j,name_i,name_j,tanimoto)")
+                   help="Optional output TSV of (i,j,name_i,name_j,tanimoto), sorted by (i, j) "
+                        "unless the pairs-only popcount prefilter reorders rows")
     p.add_argument("--pairs-thresh", type=float, default=0.85,
                    help="Minimum similarity to write to --out-pairs (default 0.85)")
     p.add_argument("--row-batch", type=int, default=2000,
                    help="Row batch size (default 2000)")
     p.add_argument("--col-batch", type=int, default=2000,
                    help="Column batch size (default 2000)")
-    return p.parse_args()
+    p.add_argument("--verbose", action="store_true",
+                   help="Log progress about every tenth block of this rank's block list")
+    p.add_argument("--fp-workers", type=int, default=max(1, (os.cpu_count() or 1) // node_size),
+                   help="Processes per rank for fingerprinting on a cache miss "
+                        "(default cores / ranks on this node)")
+    p.add_argument("--fp-cache", default="cache",
+                   help="Directory for cached fingerprint arrays, keyed by the input (default cache; '' disables)")
+    args = p.parse_args()
+    if args.out_pairs is None and (args.out_matrix is None or args.pairs_only):
+        p.error("nothing to write: give --out-matrix and/or --out-pairs")
+    return args
 
 
 # ---------- IO ----------
 def read_table(path: str) -> pd.DataFrame:
-    # Autodetect delimiter
-    try:
-        df = pd.read_csv(path)
-    except Exception:
-        df = pd.read_csv(path, sep="\t")
-    cols = {c.strip().lower(): c for c in df.columns}
-    #name_col = cols.get("name")
-    #smi_col = cols.get("canonical_smiles") or cols.get("smiles")
+    # Detect the delimiter and the column names from the header line once
+    with open(path) as f:
+        header = f.readline()
+    sep = "\t" if header.count("\t") > header.count(",") else ","
+    cols = {c.strip().lower(): c for c in header.rstrip("\r\n").split(sep)}
+    name_col = cols.get("name")
+    smi_col = cols.get("canonical_smiles") or cols.get("smiles")
     if not name_col or not smi_col:
         raise ValueError("Input must have columns 'name' and 'canonical_smiles' (or 'SMILES').")
-    out = df[['name', 'canonical_smiles']].rename(columns={'name': "name", 'canonical_smiles': "smiles"}).copy()
+    df = pd.read_csv(path, sep=sep, usecols=[name_col, smi_col],
+                     dtype={name_col: str, smi_col: str}, keep_default_na=False, engine="c")
+    out = df[[name_col, smi_col]].rename(columns={name_col: "name", smi_col: "smiles"})
     out["name"] = out["name"].astype(str)
     out["smiles"] = out["smiles"].astype(str)
     return out
 
 
 # ---------- FP ----------
-morgan_gen = GetMorganGenerator(radius=2, fpSize=2048)
+FP_BITS = 2048
+FP_WORDS = FP_BITS // 64
+morgan_gen = GetMorganGenerator(radius=2, fpSize=FP_BITS)
 
 def smiles_to_fp(s: str):
     if not isinstance(s, str) or not s.strip():
@@ -90,39 +186,250 @@ def smiles_to_fp(s: str):
         return None
 
 
+def _smi_to_packed(s: str):
+    """Pool worker: the 256-byte packed fingerprint of one SMILES, or None."""
+    fp = smiles_to_fp(s)
+    return None if fp is None else DataStructs.BitVectToBinaryText(fp)
+
+
+def fingerprint_matrix(smiles: List[str], workers: int = 1) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fingerprint every SMILES straight into structure-of-arrays form:
+    FP (n, FP_WORDS) uint64 packed bits, valid (n,) bool and popc (n,) uint16.
+    Failed parses get an all-zero row and valid=False; no RDKit objects are kept.
+    With workers > 1 the SMILES are fingerprinted in a process pool; only the
+    packed bytes come back.
+    """
+    n = len(smiles)
+    FP = np.zeros((n, FP_WORDS), dtype=np.uint64)
+    valid = np.zeros(n, dtype=bool)
+    if workers > 1 and n > 256:
+        # spawn, not fork: forking an MPI-initialised process is unsafe with
+        # some transports (OpenMPI warns; verbs/UCX state can be corrupted).
+        # The spawned workers re-import this script without initialising MPI.
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context("spawn")) as ex:
+            packed = list(ex.map(_smi_to_packed, smiles, chunksize=256))
+    else:
+        packed = map(_smi_to_packed, smiles)
+    for i, b in enumerate(packed):
+        if b is not None:
+            FP[i] = np.frombuffer(b, dtype=np.uint64)
+            valid[i] = True
+    popc = np.bitwise_count(FP).sum(axis=1).astype(np.uint16)
+    return FP, valid, popc
+
+
+def fp_cache_key(names: List[str], smiles: List[str]) -> str:
+    """Hash of the ordered (name, smiles) rows and the fingerprint settings."""
+    h = hashlib.sha1(f"morgan2-{FP_BITS}\n".encode())
+    for name, s in zip(names, smiles):
+        h.update(f"{name}\t{s}\n".encode())
+    return h.hexdigest()
+
+
+def fp_cache_paths(cache_dir: str, key: str) -> Tuple[str, str, str]:
+    base = os.path.join(cache_dir, key)
+    return base + ".fp.u64", base + ".valid.u8", base + ".popc.u16"
+
+
+def load_fp_cache(paths: Tuple[str, str, str], n: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Map the cached arrays read-only; ranks on one node share the page cache."""
+    fp_path, valid_path, popc_path = paths
+    FP = np.asarray(np.memmap(fp_path, dtype=np.uint64, mode="r", shape=(n, FP_WORDS)))
+    valid = np.asarray(np.memmap(valid_path, dtype=bool, mode="r", shape=(n,)))
+    popc = np.asarray(np.memmap(popc_path, dtype=np.uint16, mode="r", shape=(n,)))
+    return FP, valid, popc
+
+
+def save_fp_cache(paths: Tuple[str, str, str], FP: np.ndarray, valid: np.ndarray, popc: np.ndarray):
+    """Write each array to a temp file and rename it, so readers never see a partial cache."""
+    os.makedirs(os.path.dirname(paths[0]) or ".", exist_ok=True)
+    for path, arr in zip(paths, (FP, valid, popc)):
+        tmp = f"{path}.tmp{os.getpid()}"
+        arr.tofile(tmp)
+        os.replace(tmp, path)
+
+
 # ---------- Batching ----------
+# Sub-block edge used inside compute_block for the AND/popcount temporary
+TILE = 128
+# Query / target tile rows in the numba kernel (L1-resident tile pairs)
+KI = 8
+KJ = 64
+
 def make_batches(n: int, batch_size: int) -> List[Tuple[int, int]]:
     """Return list of (start, end) half-open index ranges covering 0..n."""
     return [(i, min(i + batch_size, n)) for i in range(0, n, batch_size)]
 
 
-def compute_block(qfps, qvalid, tfps, tvalid) -> np.ndarray:
+# ---------- Kernels ----------
+def load_c_kernel():
+    """
+    Return tanimoto_tile from libtanimoto.so (built from tanimoto_avx512.c next
+    to this script) via ctypes, or None if the library has not been built.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "libtanimoto.so")
+    try:
+        lib = ctypes.CDLL(path)
+    except OSError:
+        return None
+    u64 = np.ctypeslib.ndpointer(np.uint64, ndim=2, flags="C_CONTIGUOUS")
+    u16 = np.ctypeslib.ndpointer(np.uint16, ndim=1, flags="C_CONTIGUOUS")
+    f32 = np.ctypeslib.ndpointer(np.float32, ndim=2, flags="C_CONTIGUOUS")
+    fn = lib.tanimoto_tile
+    fn.argtypes = [u64, u64, ctypes.c_int, ctypes.c_int, u16, u16, f32]
+    fn.restype = None
+    return fn
+
+c_tanimoto_tile = load_c_kernel()
+
+if njit is not None:
+    @intrinsic
+    def popcount64(typingctx, x):
+        """Lower to LLVM's ctpop, i.e. a single POPCNT instruction on x86-64; at most 64, returned as int32."""
+        sig = types.int32(types.uint64)
+        def codegen(context, builder, signature, args):
+            return builder.trunc(builder.ctpop(args[0]), context.get_value_type(types.int32))
+        return sig, codegen
+
+    # Kernel signatures: packed uint64 rows, uint16 popcounts, float32 output
+    # (C-contiguous); the read-only variant covers memory-mapped cache arrays.
+    # They are compiled by compute_block_setup, not at import (see there).
+    def _kernel_sig(readonly):
+        u64 = types.Array(types.uint64, 2, "C", readonly=readonly)
+        u16 = types.Array(types.uint16, 1, "C", readonly=readonly)
+        return types.void(u64, u64, u16, u16, types.float32[:, ::1])
+
+    KERNEL_SIGS = [_kernel_sig(False), _kernel_sig(True)]
+
+    @njit(parallel=True, boundscheck=False, cache=True)
+    def tanimoto_block(Q, T, aq, at, out):
+        """
+        Fused AND + popcount + Tanimoto; writes into out. Threads take KI-row
+        query tiles, and each tile is swept over KJ-row target tiles so both
+        stay in L1 (8 x 256 B and 64 x 256 B) while the tile pair is computed.
+        Intersections and denominators stay int32 until one float32 divide.
+        """
+        nq, nt = Q.shape[0], T.shape[0]
+        for it in prange((nq + KI - 1) // KI):
+            i0 = it * KI
+            i1 = min(i0 + KI, nq)
+            for j0 in range(0, nt, KJ):
+                j1 = min(j0 + KJ, nt)
+                for i in range(i0, i1):
+                    a = np.int32(aq[i])
+                    for j in range(j0, j1):
+                        c = np.int32(0)
+                        for w in range(Q.shape[1]):
+                            c += popcount64(Q[i, w] & T[j, w])
+                        # RDKit returns 0.0 when both fingerprints are empty
+                        d = max(a + np.int32(at[j]) - c, np.int32(1))
+                        out[i, j] = np.float32(c) / np.float32(d)
+
+
+def compute_block_setup():
+    """
+    Compile the numba kernel for KERNEL_SIGS only, if it is the kernel in use.
+    Must run after fingerprinting: compiling a parallel kernel starts numba's
+    threading layer, and a process pool started after that hangs at exit.
+    """
+    if c_tanimoto_tile is None and njit is not None:
+        for sig in KERNEL_SIGS:
+            tanimoto_block.compile(sig)
+        tanimoto_block.disable_compile()
+
+
+def compute_block(Q: np.ndarray, aq: np.ndarray, qvalid: np.ndarray,
+                  T: np.ndarray, at: np.ndarray, tvalid: np.ndarray) -> np.ndarray:
+    """
+    Compute a (len(Q) x len(T)) block. Places NaN where either side is invalid.
+    Q/T are packed uint64 fingerprints, aq/at their popcounts; the intersection
+    is AND + popcount over the 64-bit words, in TILE x TILE sub-blocks so the
+    broadcast temporary stays small. The C kernel (libtanimoto.so) is preferred
+    when built, then the fused numba kernel; neither allocates a temporary.
+    """
+    out = np.empty((len(Q), len(T)), dtype=np.float32)
+    if c_tanimoto_tile is not None:
+        c_tanimoto_tile(Q, T, len(Q), len(T), aq, at, out)
+    elif njit is not None:
+        tanimoto_block(Q, T, aq, at, out)
+    else:
+        for i0 in range(0, len(Q), TILE):
+            q, a = Q[i0:i0 + TILE], aq[i0:i0 + TILE]
+            for j0 in range(0, len(T), TILE):
+                t, b = T[j0:j0 + TILE], at[j0:j0 + TILE]
+                inter = np.bitwise_count(q[:, None, :] & t[None, :, :]).sum(-1, dtype=np.int32)
+                # RDKit returns 0.0 when both fingerprints are empty
+                denom = np.maximum(a[:, None] + b[None, :] - inter, 1)
+                out[i0:i0 + TILE, j0:j0 + TILE] = inter / denom
+    # Invalid rows are all-zero fingerprints, so every kernel gives a finite
+    # value there; blank them with one outer-product mask instead of branching
+    np.copyto(out, np.nan, where=~(qvalid[:, None] & tvalid[None, :]))
+    return out
+
+
+# ---------- Pairs ----------
+def pair_lines(block: np.ndarray, rs: int, cs: int, names: List[str], thresh: float,
+               ids: np.ndarray = None) -> bytes:
     """
-    Compute a (len(qfps) x len(tfps)) block. Places NaN where either side is invalid.
-    Uses BulkTanimotoSimilarity on valid targets for speed.
+    Format the thresholded upper-triangle entries (j > i, s >= thresh) of the
+    block M[rs:rs+h, cs:cs+w] as pairs-TSV lines, sorted by (i, j) within the
+    block. NaNs never pass. If rows were permuted, ids maps them back to input order.
     """
-    rows = []
-    # Pre-collect indices of valid targets
-    t_idx_valid = [j for j, ok in enumerate(tvalid) if ok]
-    tfps_valid  = [tfps[j] for j in t_idx_valid]
+    w = block.shape[1]
+    idx = np.flatnonzero(block >= thresh)
+    ii, jj = np.divmod(idx, w) if w else (idx, idx)
+    ii += rs
+    jj += cs
+    keep = jj > ii
+    ii, jj = ii[keep], jj[keep]
+    sims = block[ii - rs, jj - cs].astype(np.float64).tolist()
+    if ids is not None:
+        ii, jj = ids[ii], ids[jj]
+        ii, jj = np.minimum(ii, jj), np.maximum(ii, jj)
+    return "".join([f"{i}\t{j}\t{names[i]}\t{names[j]}\t{v:.6f}\n"
+                    for i, j, v in zip(ii.tolist(), jj.tolist(), sims)]).encode()
 
-    for i, (qfp, ok_q) in enumerate(zip(qfps, qvalid)):
-        if not ok_q:
-            rows.append([np.nan] * len(tfps))
-            continue
-        sims_valid = DataStructs.BulkTanimotoSimilarity(qfp, tfps_valid) if tfps_valid else []
-        # expand to full-length row with NaN where target invalid
-        row = [np.nan] * len(tfps)
-        for k, j in enumerate(t_idx_valid):
-            row[j] = sims_valid[k]
-        rows.append(row)
-        if i % 50 == 0 and i > 0:
-            print(f"Rank {rank}: processed {i} rows in current block.", flush=True)
-    return np.asarray(rows, dtype=np.float32)
+
+def _pair_row(line: bytes) -> int:
+    """Row index i of a pairs-TSV line."""
+    return int(line[:line.index(b"\t")])
+
+
+# Output buffer for the pairs part files, the stitched TSV and the matrix CSV
+WRITE_BUFFER = 1 << 20
+
+
+# ---------- Matrix ----------
+def _csv_field(s: str) -> str:
+    """Quote a name the way the csv module would, if it needs it."""
+    if any(ch in s for ch in ',"\r\n'):
+        return '"' + s.replace('"', '""') + '"'
+    return s
+
+
+def write_matrix_csv(path: str, M: np.ndarray, names: List[str], rows_per_chunk: int = 256):
+    """
+    Stream M as CSV with names as header and index, a chunk of rows at a time,
+    instead of building one DataFrame. NaN is written as an empty field.
+    """
+    fields = [_csv_field(name) for name in names]
+    with open(path, "w", buffering=WRITE_BUFFER) as f:
+        f.write(",".join([""] + fields) + "\n")
+        for r0 in range(0, M.shape[0], rows_per_chunk):
+            buf = io.StringIO()
+            np.savetxt(buf, M[r0:r0 + rows_per_chunk], fmt="%.6f", delimiter=",")
+            lines = buf.getvalue().replace("nan", "").splitlines()
+            f.write("".join(f"{name},{line}\n" for name, line in zip(fields[r0:r0 + rows_per_chunk], lines)))
 
 
 def main():
     args = parse_args()
+    handler = BufferedStderrHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(handler)
+    log.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
 
     # Rank 0 loads and broadcasts
     if rank == 0:
@@ -136,98 +443,175 @@ def main():
         smiles = None
         n = None
 
-    names = comm.bcast(names, root=0)
-    smiles = comm.bcast(smiles, root=0)
-    n = comm.bcast(len(names) if rank == 0 else None, root=0)
-
-    # Precompute fingerprints once per rank (read-only reuse)
-    fps = [smiles_to_fp(s) for s in smiles]
-    valid = np.array([fp is not None for fp in fps], dtype=bool)
+    names, smiles = bcast_strings(names, smiles)
+    n = len(names)
+
+    # Fingerprints are cached on disk keyed by the input rows; rank 0 decides
+    # whether the cache is usable so every rank takes the same branch
+    cache_paths = None
+    if args.fp_cache:
+        cache_paths = fp_cache_paths(args.fp_cache, fp_cache_key(names, smiles))
+    hit = comm.bcast(cache_paths is not None and all(os.path.exists(pth) for pth in cache_paths)
+                     if rank == 0 else None, root=0)
+
+    if hit:
+        FP, valid, popc = load_fp_cache(cache_paths, n)
+        if rank == 0:
+            print(f"[rank 0] Loaded fingerprints from cache: {cache_paths[0]}", flush=True)
+    else:
+        # Each rank fingerprints one contiguous shard, then the shards are
+        # all-gathered so every rank holds the full (read-only) arrays
+        counts = [n // size + (r < n % size) for r in range(size)]
+        displs = np.cumsum([0] + counts[:-1]).tolist()
+        s0 = displs[rank]
+        FP_mine, valid_mine, popc_mine = fingerprint_matrix(smiles[s0:s0 + counts[rank]],
+                                                               args.fp_workers)
+        FP = np.empty((n, FP_WORDS), dtype=np.uint64)
+        valid = np.empty(n, dtype=bool)
+        popc = np.empty(n, dtype=np.uint16)
+        MPI.Request.Waitall([
+            comm.Iallgatherv([FP_mine, MPI.UINT64_T],
+                             [FP, [c * FP_WORDS for c in counts], [d * FP_WORDS for d in displs], MPI.UINT64_T]),
+            comm.Iallgatherv([valid_mine, MPI.C_BOOL], [valid, counts, displs, MPI.C_BOOL]),
+            comm.Iallgatherv([popc_mine, MPI.UINT16_T], [popc, counts, displs, MPI.UINT16_T]),
+        ])
+        if rank == 0 and cache_paths is not None:
+            save_fp_cache(cache_paths, FP, valid, popc)
+            print(f"[rank 0] Wrote fingerprint cache: {cache_paths[0]}", flush=True)
+
+    compute_block_setup()
+
+    # Pairs-only runs with a positive threshold can use the popcount bound
+    # T(i, j) <= min(a_i, a_j) / max(a_i, a_j): rows are sorted by popcount so
+    # whole blocks that cannot reach the threshold are dropped from the tasks
+    keep_matrix = args.out_matrix is not None and not args.pairs_only
+    prefilter = not keep_matrix and args.pairs_thresh > 0
+    ids = None
+    if prefilter:
+        ids = np.argsort(popc, kind="stable")
+        FP, valid, popc = FP[ids], valid[ids], popc[ids]
 
     # Batches for rows and columns (all ranks agree on these)
     row_batches = make_batches(n, args.row_batch)
     col_batches = make_batches(n, args.col_batch)
 
-    # Assign row batches round-robin across ranks
-    my_row_batches = row_batches[rank::size]
-    print(f"[rank {rank}] Assigned {len(my_row_batches)} row batches.", flush=True)
-
-    # For assembling on root, we will send (row_start, block_matrix) per processed block
-    my_blocks = []
-    for (rs, re) in my_row_batches:
-        qfps   = fps[rs:re]
-        qvalid = valid[rs:re]
-        row_block_parts = []
-        for (cs, ce) in col_batches:
-            tfps   = fps[cs:ce]
-            tvalid = valid[cs:ce]
-            block = compute_block(qfps, qvalid, tfps, tvalid)
-            row_block_parts.append(block)
-            print(f"[rank {rank}] Block rows [{rs}:{re}) x cols [{cs}:{ce}) -> {block.shape}", flush=True)
-        # concat horizontally to full-width block for these rows
-        full_row_block = np.hstack(row_block_parts)
-        my_blocks.append((rs, full_row_block))
-
-    # Gather all blocks on root
-    gathered = comm.gather(my_blocks, root=0)
-
-    if rank == 0:
-        # Preallocate final matrix
+    # 2D decomposition: one task per (row batch, column batch) block on or above
+    # the diagonal (ce > rs), dealt round-robin so the triangle stays balanced.
+    # Tanimoto is symmetric, so each pair is computed once and rank 0 mirrors
+    # the upper triangle into the lower one afterwards.
+    tasks = [(rs, re, cs, ce) for (rs, re) in row_batches for (cs, ce) in col_batches if ce > rs]
+    if prefilter:
+        # Blocks are never below the diagonal, so a_j >= a_min * thresh always
+        # holds; only the upper end a_j <= a_max / thresh can prune
+        tasks = [(rs, re, cs, ce) for (rs, re, cs, ce) in tasks
+                 if popc[cs] <= popc[re - 1] / args.pairs_thresh]
+    my_tasks = tasks[rank::size]
+    print(f"[rank {rank}] Assigned {len(my_tasks)} of {len(tasks)} blocks.", flush=True)
+
+    # With --verbose, log roughly ten blocks per rank
+    log_every = max(1, len(my_tasks) // 10)
+
+    # Rank 0 pre-posts one Irecv per foreign block, with a subarray datatype
+    # so it lands in place in M; every other rank Isends each block as soon as
+    # it is computed (tagged with its index in that rank's task list).
+    # With --out-pairs every rank also appends its thresholded pairs to its own
+    # part file as each block finishes, remembering (rs, cs, offset, length)
+    reqs = []
+    block_types = []
+    part = None
+    segments = []
+    if args.out_pairs is not None:
+        part_path = f"{args.out_pairs}.part{rank}"
+        part = open(part_path, "wb", buffering=WRITE_BUFFER)
+    if rank == 0 and keep_matrix:
         M = np.full((n, n), np.nan, dtype=np.float32)
-        # Place each gathered block into the right rows
-        for rank_blocks in gathered:
-            for (rs, block) in rank_blocks:
-                re = rs + block.shape[0]
-                M[rs:re, :] = block
-
-        # Enforce symmetry by averaging upper/lower where both defined; prefer max otherwise
-        iu = np.triu_indices(n, 1)
-        upper = M[iu]
-        lower = M[(iu[1], iu[0])]
-        # When both are finite, average; when one is NaN, take the other
-        both = ~np.isnan(upper) & ~np.isnan(lower)
-        only_u = ~np.isnan(upper) & np.isnan(lower)
-        only_l = np.isnan(upper) & ~np.isnan(lower)
-
-        sym_u = np.copy(upper)
-        sym_l = np.copy(lower)
-        sym_u[both] = (upper[both] + lower[both]) / 2.0
-        sym_l[both] = sym_u[both]
-        sym_l[only_u] = upper[only_u]
-        sym_u[only_l] = lower[only_l]
-
-        M[iu] = sym_u
-        M[(iu[1], iu[0])] = sym_l
+        for r in range(1, size):
+            for k, (rs, re, cs, ce) in enumerate(tasks[r::size]):
+                bt = MPI.FLOAT.Create_subarray([n, n], [re - rs, ce - cs], [rs, cs]).Commit()
+                block_types.append(bt)
+                reqs.append(comm.Irecv([M, 1, bt], source=r, tag=k))
+    for k, (rs, re, cs, ce) in enumerate(my_tasks):
+        if rank == 0 and keep_matrix:
+            block = M[rs:re, cs:ce]
+        else:
+            block = np.full((re - rs, ce - cs), np.nan, dtype=np.float32)
+        if cs >= re:
+            slabs = [(rs, re, cs)]
+        else:
+            # Block straddles the diagonal: walk it in TILE-row slabs that
+            # each start at their own diagonal, so j < i is (almost) never computed
+            slabs = [(r0, min(r0 + TILE, re), max(cs, r0)) for r0 in range(rs, re, TILE)]
+        for (r0, r1, c_lo) in slabs:
+            if c_lo >= ce:
+                continue
+            block[r0 - rs:r1 - rs, c_lo - cs:] = compute_block(
+                FP[r0:r1], popc[r0:r1], valid[r0:r1],
+                FP[c_lo:ce], popc[c_lo:ce], valid[c_lo:ce])
+        if k % log_every == 0:
+            log.debug("[rank %d] Block rows [%d:%d) x cols [%d:%d)", rank, rs, re, cs, ce)
+        if part is not None:
+            buf = pair_lines(block, rs, cs, names, args.pairs_thresh, ids)
+            segments.append((rs, cs, part.tell(), len(buf)))
+            part.write(buf)
+        if rank != 0 and keep_matrix:
+            reqs.append(comm.Isend([block, MPI.FLOAT], dest=0, tag=k))
+    MPI.Request.Waitall(reqs)
+    for bt in block_types:
+        bt.Free()
+
+    if part is not None:
+        part.close()
+        # Rank 0 stitches the parts together one row batch at a time. Lines are
+        # sorted by (i, j) within each block and the blocks of a row batch
+        # cover increasing column ranges, so merging them on i (ties keep block
+        # order) keeps the file sorted by (i, j). With the popcount prefilter
+        # rows are permuted and the blocks are just concatenated.
+        all_segments = comm.gather([(rs, cs, rank, off, ln) for (rs, cs, off, ln) in segments], root=0)
+        if rank == 0:
+            count = 0
+            with open(args.out_pairs, "wb", buffering=WRITE_BUFFER) as f:
+                f.write(b"i\tj\tname_i\tname_j\ttanimoto\n")
+                parts = [open(f"{args.out_pairs}.part{r}", "rb") for r in range(size)]
+                segs = sorted(seg for segs in all_segments for seg in segs)
+                for _, row_segs in groupby(segs, key=lambda seg: seg[0]):
+                    bufs = []
+                    for (rs, cs, r, off, ln) in row_segs:
+                        parts[r].seek(off)
+                        bufs.append(parts[r].read(ln))
+                        count += bufs[-1].count(b"\n")
+                    if ids is None and len(bufs) > 1:
+                        f.writelines(heapq.merge(*(buf.splitlines(True) for buf in bufs), key=_pair_row))
+                    else:
+                        f.writelines(bufs)
+                for fh in parts:
+                    fh.close()
+                    os.remove(fh.name)
+            print(f"[rank 0] Wrote pairs: {args.out_pairs} (>= {args.pairs_thresh}) with {count} rows")
+
+    if rank == 0 and keep_matrix:
+        # Mirror the strict upper triangle into the lower one, one row batch at
+        # a time: the part right of the batch, then its diagonal square
+        for (rs, re) in row_batches:
+            M[re:, rs:re] = M[rs:re, re:].T
+            sq = M[rs:re, rs:re]
+            il = np.tril_indices(re - rs, -1)
+            sq[il] = sq.T[il]
 
         # Diagonal = 1.0 for valid, NaN for invalid
-        for i in range(n):
-            M[i, i] = 1.0 if valid[i] else np.nan
-
-        # Write matrix CSV (names as header and index)
-        mat_df = pd.DataFrame(M, index=names, columns=names)
-        mat_df.to_csv(args.out_matrix, index=True)
-        print(f"[rank 0] Wrote matrix: {args.out_matrix} (shape {M.shape})")
-
-        # Optional pairs TSV (upper triangle only, thresholded)
-        if args.out_pairs is not None:
-            thresh = float(args.pairs_thresh)
-            out_path = args.out_pairs
-            count = 0
-            with open(out_path, "w") as f:
-                f.write("i\tj\tname_i\tname_j\ttanimoto\n")
-                for i in range(n):
-                    # j > i to avoid duplicates & diagonal
-                    row = M[i, (i+1):]
-                    if np.all(np.isnan(row)):
-                        continue
-                    # Find indices passing threshold
-                    for k, s in enumerate(row, start=i+1):
-                        if not math.isnan(float(s)) and s >= thresh:
-                            f.write(f"{i}\t{k}\t{names[i]}\t{names[k]}\t{float(s):.6f}\n")
-                            count += 1
-                            if count % 500000 == 0:
-                                print(f"[rank 0] pairs written: {count}", flush=True)
-            print(f"[rank 0] Wrote pairs: {out_path} (>= {thresh}) with {count} rows")
+        M[np.diag_indices(n)] = np.where(valid, 1.0, np.nan)
+
+        if args.csv:
+            # Write matrix CSV (names as header and index)
+            write_matrix_csv(args.out_matrix, M, names)
+            out_path = args.out_matrix
+        else:
+            # Binary matrix plus one name per line; a CSV of n x n floats is
+            # far larger and slower to write and read back
+            out_path = args.out_matrix if args.out_matrix.endswith(".npy") else args.out_matrix + ".npy"
+            np.save(out_path, M)
+            with open(out_path[:-4] + ".names.txt", "w") as f:
+                f.write("".join(f"{name}\n" for name in names))
+        print(f"[rank 0] Wrote matrix: {out_path} (shape {M.shape})")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,229 @@
+/*
+ * tanimoto_avx512.c
+ *
+ * Tanimoto tile kernel for packed 2048-bit fingerprints (32 x uint64 per row),
+ * loaded by AllvsAllMPIsimilaritySearch.py through ctypes when present.
+ *
+ * Build (next to the Python script):
+ *   gcc -O3 -mpopcnt -shared -fPIC -o libtanimoto.so tanimoto_avx512.c
+ *
+ * Three variants are compiled into the library and one is picked when it is
+ * loaded, from what the CPU supports (override with TANIMOTO_ISA=avx512|avx2|
+ * scalar):
+ *   avx512  AVX-512 VPOPCNTDQ (Ice Lake / Zen 4 and newer). TI = 4 query
+ *           fingerprints are held in 16 ZMM registers and each target is
+ *           loaded once for all of them: 4 AND + 4 VPOPCNTQ and one horizontal
+ *           reduction per pair.
+ *   avx2    Mula's PSHUFB nibble-lookup popcount (Haswell .. Skylake-X). The
+ *           query sits in 8 YMM registers; per target, 8 AND + 16 PSHUFB give
+ *           byte counts that are summed in 8-bit lanes and reduced with one
+ *           VPSADBW.
+ *   scalar  POPCNT over the 32 words.
+ * All of them walk the targets in tiles of TJ rows (64 x 256 B = 16 KB) that
+ * stay in L1 while every query row passes over them.
+ */
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#if defined(__x86_64__) || defined(__i386__)
+#include <immintrin.h>
+#define TANIMOTO_X86 1
+#endif
+
+#define FP_WORDS 32
+#define TI 4   /* query rows per register block (AVX-512 path) */
+#define TJ 64  /* target rows per L1 tile */
+
+typedef void (*tile_fn)(const uint64_t *, const uint64_t *, int, int,
+                        const uint16_t *, const uint16_t *, float *);
+
+/* Popcounts and intersections are at most 2048, so 32-bit integers and one
+ * float division suffice; for operands this small the float quotient is
+ * correctly rounded, i.e. the same value the NumPy path gets from double.
+ * Two empty fingerprints give 0.0, as in RDKit. */
+static inline float tanimoto(int32_t c, uint16_t a, uint16_t b)
+{
+    const int32_t d = (int32_t)a + (int32_t)b - c;
+    return d > 0 ? (float)c / (float)d : 0.0f;
+}
+
+/* ---------- scalar ---------- */
+
+/* One query row against targets [j0, j1). */
+static void row_scalar(const uint64_t *q, uint16_t a, const uint64_t *T,
+                       int j0, int j1, const uint16_t *at, float *row)
+{
+    for (int j = j0; j < j1; j++) {
+        const uint64_t *t = T + (int64_t)j * FP_WORDS;
+        int32_t c = 0;
+        for (int w = 0; w < FP_WORDS; w++)
+            c += __builtin_popcountll(q[w] & t[w]);
+        row[j] = tanimoto(c, a, at[j]);
+    }
+}
+
+static void tile_scalar(const uint64_t *Q, const uint64_t *T, int nq, int nt,
+                        const uint16_t *aq, const uint16_t *at, float *out)
+{
+    for (int j0 = 0; j0 < nt; j0 += TJ) {
+        const int j1 = j0 + TJ < nt ? j0 + TJ : nt;
+        for (int i = 0; i < nq; i++)
+            row_scalar(Q + (int64_t)i * FP_WORDS, aq[i], T, j0, j1, at,
+                       out + (int64_t)i * nt);
+    }
+}
+
+#ifdef TANIMOTO_X86
+/* ---------- AVX2 (Mula PSHUFB) ---------- */
+
+__attribute__((target("avx2")))
+static void row_avx2(const uint64_t *q, uint16_t a, const uint64_t *T,
+                     int j0, int j1, const uint16_t *at, float *row)
+{
+    const __m256i lut = _mm256_setr_epi8(0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4,
+                                         0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4);
+    const __m256i low4 = _mm256_set1_epi8(0x0f);
+    __m256i qv[8];
+    for (int k = 0; k < 8; k++)
+        qv[k] = _mm256_loadu_si256((const __m256i *)(q + 4 * k));
+    for (int j = j0; j < j1; j++) {
+        const uint64_t *t = T + (int64_t)j * FP_WORDS;
+        /* at most 8 bits per byte per vector, so 8 vectors fit in a uint8 lane */
+        __m256i bytes = _mm256_setzero_si256();
+        for (int k = 0; k < 8; k++) {
+            const __m256i v = _mm256_and_si256(qv[k], _mm256_loadu_si256((const __m256i *)(t + 4 * k)));
+            const __m256i lo = _mm256_and_si256(v, low4);
+            const __m256i hi = _mm256_and_si256(_mm256_srli_epi16(v, 4), low4);
+            bytes = _mm256_add_epi8(bytes, _mm256_add_epi8(_mm256_shuffle_epi8(lut, lo),
+                                                           _mm256_shuffle_epi8(lut, hi)));
+        }
+        const __m256i sums = _mm256_sad_epu8(bytes, _mm256_setzero_si256());
+        const __m128i s2 = _mm_add_epi64(_mm256_castsi256_si128(sums),
+                                         _mm256_extracti128_si256(sums, 1));
+        const int32_t c = (int32_t)(_mm_cvtsi128_si64(s2) + _mm_extract_epi64(s2, 1));
+        row[j] = tanimoto(c, a, at[j]);
+    }
+}
+
+__attribute__((target("avx2")))
+static void tile_avx2(const uint64_t *Q, const uint64_t *T, int nq, int nt,
+                      const uint16_t *aq, const uint16_t *at, float *out)
+{
+    for (int j0 = 0; j0 < nt; j0 += TJ) {
+        const int j1 = j0 + TJ < nt ? j0 + TJ : nt;
+        for (int i = 0; i < nq; i++)
+            row_avx2(Q + (int64_t)i * FP_WORDS, aq[i], T, j0, j1, at,
+                     out + (int64_t)i * nt);
+    }
+}
+
+/* ---------- AVX-512 VPOPCNTDQ ---------- */
+
+#define AVX512_TARGET __attribute__((target("avx512f,avx512vpopcntdq")))
+
+AVX512_TARGET
+static void row_avx512(const uint64_t *q, uint16_t a, const uint64_t *T,
+                       int j0, int j1, const uint16_t *at, float *row)
+{
+    const __m512i q0 = _mm512_loadu_si512((const void *)(q + 0));
+    const __m512i q1 = _mm512_loadu_si512((const void *)(q + 8));
+    const __m512i q2 = _mm512_loadu_si512((const void *)(q + 16));
+    const __m512i q3 = _mm512_loadu_si512((const void *)(q + 24));
+    for (int j = j0; j < j1; j++) {
+        const uint64_t *t = T + (int64_t)j * FP_WORDS;
+        __m512i acc = _mm512_popcnt_epi64(
+            _mm512_and_si512(q0, _mm512_loadu_si512((const void *)(t + 0))));
+        acc = _mm512_add_epi64(acc, _mm512_popcnt_epi64(
+            _mm512_and_si512(q1, _mm512_loadu_si512((const void *)(t + 8)))));
+        acc = _mm512_add_epi64(acc, _mm512_popcnt_epi64(
+            _mm512_and_si512(q2, _mm512_loadu_si512((const void *)(t + 16)))));
+        acc = _mm512_add_epi64(acc, _mm512_popcnt_epi64(
+            _mm512_and_si512(q3, _mm512_loadu_si512((const void *)(t + 24)))));
+        row[j] = tanimoto((int32_t)_mm512_reduce_add_epi64(acc), a, at[j]);
+    }
+}
+
+/* TI query rows (starting at q, rows FP_WORDS apart) against targets [j0, j1). */
+AVX512_TARGET
+static void rows_ti_avx512(const uint64_t *q, const uint16_t *a, const uint64_t *T,
+                           int j0, int j1, const uint16_t *at, float *out, int nt)
+{
+    __m512i qv[TI][4];
+    for (int r = 0; r < TI; r++)
+        for (int k = 0; k < 4; k++)
+            qv[r][k] = _mm512_loadu_si512((const void *)(q + (int64_t)r * FP_WORDS + 8 * k));
+    for (int j = j0; j < j1; j++) {
+        const uint64_t *t = T + (int64_t)j * FP_WORDS;
+        const __m512i t0 = _mm512_loadu_si512((const void *)(t + 0));
+        const __m512i t1 = _mm512_loadu_si512((const void *)(t + 8));
+        const __m512i t2 = _mm512_loadu_si512((const void *)(t + 16));
+        const __m512i t3 = _mm512_loadu_si512((const void *)(t + 24));
+        for (int r = 0; r < TI; r++) {
+            __m512i acc = _mm512_popcnt_epi64(_mm512_and_si512(qv[r][0], t0));
+            acc = _mm512_add_epi64(acc, _mm512_popcnt_epi64(_mm512_and_si512(qv[r][1], t1)));
+            acc = _mm512_add_epi64(acc, _mm512_popcnt_epi64(_mm512_and_si512(qv[r][2], t2)));
+            acc = _mm512_add_epi64(acc, _mm512_popcnt_epi64(_mm512_and_si512(qv[r][3], t3)));
+            out[(int64_t)r * nt + j] = tanimoto((int32_t)_mm512_reduce_add_epi64(acc), a[r], at[j]);
+        }
+    }
+}
+
+AVX512_TARGET
+static void tile_avx512(const uint64_t *Q, const uint64_t *T, int nq, int nt,
+                        const uint16_t *aq, const uint16_t *at, float *out)
+{
+    for (int j0 = 0; j0 < nt; j0 += TJ) {
+        const int j1 = j0 + TJ < nt ? j0 + TJ : nt;
+        int i = 0;
+        for (; i + TI <= nq; i += TI)
+            rows_ti_avx512(Q + (int64_t)i * FP_WORDS, aq + i, T, j0, j1, at,
+                           out + (int64_t)i * nt, nt);
+        for (; i < nq; i++)
+            row_avx512(Q + (int64_t)i * FP_WORDS, aq[i], T, j0, j1, at,
+                       out + (int64_t)i * nt);
+    }
+}
+#endif /* TANIMOTO_X86 */
+
+/* ---------- dispatch ---------- */
+
+static tile_fn selected = tile_scalar;
+static const char *selected_name = "scalar";
+
+__attribute__((constructor))
+static void select_kernel(void)
+{
+#ifdef TANIMOTO_X86
+    const char *force = getenv("TANIMOTO_ISA");
+    int avx512, avx2;
+    __builtin_cpu_init();
+    avx512 = __builtin_cpu_supports("avx512f") && __builtin_cpu_supports("avx512vpopcntdq");
+    avx2 = __builtin_cpu_supports("avx2");
+    if (force) {
+        /* a forced ISA is only honoured if the CPU actually has it */
+        avx512 = avx512 && strcmp(force, "avx512") == 0;
+        avx2 = avx2 && strcmp(force, "avx2") == 0;
+    }
+    if (avx512) {
+        selected = tile_avx512;
+        selected_name = "avx512";
+    } else if (avx2) {
+        selected = tile_avx2;
+        selected_name = "avx2";
+    }
+#endif
+}
+
+/* Name of the variant picked at load time ("avx512", "avx2" or "scalar"). */
+const char *tanimoto_isa(void)
+{
+    return selected_name;
+}
+
+/* out[i * nt + j] = Tanimoto(Q[i], T[j]); aq/at are the row popcounts. */
+void tanimoto_tile(const uint64_t *Q, const uint64_t *T, int nq, int nt,
+                   const uint16_t *aq, const uint16_t *at, float *out)
+{
+    selected(Q, T, nq, nt, aq, at, out);
+}